@@ -0,0 +1,59 @@
+import subprocess
+import sys
+import time
+from datetime import timedelta
+from io import StringIO
+from typing import Callable
+
+from subword_nmt.apply_bpe import BPE
+
+from manager import Tokenizer, Vocab, load_checkpoint
+
+DEFERRED = ('comet', 'sacrebleu.metrics')
+
+
+def time_import(modules: list[str], repeat: int) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {", ".join(modules)}'], check=True)
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def time_call(function: Callable, repeat: int) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', metavar='FILE', required=True, help='model file (.pt)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of repetitions')
+    args = parser.parse_args()
+
+    for module in ('score', 'main'):
+        eager = timedelta(seconds=time_import([*DEFERRED, module], args.repeat))
+        lazy = timedelta(seconds=time_import([module], args.repeat))
+        print(f'Import ({module}) = {lazy} (eager = {eager})')
+
+    model_dict = load_checkpoint(args.model, 'cpu')
+    src_lang, tgt_lang = model_dict['src_lang'], model_dict['tgt_lang']
+    vocab_list, codes = model_dict['vocab_list'], ''.join(model_dict['codes_list'])
+    bpe = BPE(StringIO(codes))
+    for name, function in (
+        ('Vocab', lambda: Vocab(vocab_list)),
+        ('BPE', lambda: BPE(StringIO(codes))),
+        ('Tokenizer', lambda: Tokenizer(bpe, src_lang, tgt_lang)),
+    ):
+        print(f'Startup ({name}) = {timedelta(seconds=time_call(function, args.repeat))}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    main()
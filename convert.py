@@ -0,0 +1,23 @@
+import os
+
+from manager import load_checkpoint, save_checkpoint
+
+
+def convert_model(model_file: str, output_file: str):
+    save_checkpoint(output_file, load_checkpoint(model_file, 'cpu'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', metavar='FILE', required=True, help='model file (.pt)')
+    parser.add_argument('--output', metavar='FILE', help='output file (.safetensors)')
+    args = parser.parse_args()
+
+    output_file = args.output or os.path.splitext(args.model)[0] + '.safetensors'
+    convert_model(args.model, output_file)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    main()
@@ -3,6 +3,8 @@ from typing import TYPE_CHECKING
 import torch
 from torch import Tensor
 
+from profiler import timed
+
 if TYPE_CHECKING:
     from manager import Manager
 
@@ -20,9 +22,12 @@ def greedy_search(
     path = torch.full((1, max_length), vocab.BOS, device=device)
 
     for i in range(1, max_length):
-        tgt_encs = model.decode(src_encs.unsqueeze(0), path[:, :i], src_mask, tgt_mask[:, :i, :i])
-        logits = model.out_embed(tgt_encs[:, -1], inverse=True)
-        path[0, i] = logits.log_softmax(dim=-1).argmax(dim=-1)
+        tgt_len = min(manager.bucket(i), max_length)
+        tgt_encs = manager.decode(
+            src_encs.unsqueeze(0), path[:, :tgt_len], src_mask, tgt_mask[:, :tgt_len, :tgt_len]
+        )
+        logits = model.out_embed(tgt_encs[:, i - 1], inverse=True)
+        path[0, i] = logits.float().log_softmax(dim=-1).argmax(dim=-1)
         if path[0, i] == vocab.EOS:
             break
 
@@ -44,30 +49,97 @@ def beam_search(
 
     i, init_size = 0, beam_size
     while (i := i + 1) < max_length and beam_size > 0:
-        tgt_encs = model.decode(
-            src_encs.expand(beam_size, -1, -1), paths[active, :i], src_mask, tgt_mask[:, :i, :i]
+        tgt_len = min(manager.bucket(i), max_length)
+        rows = torch.ones_like(active) if manager.compile else active
+        tgt_encs = manager.decode(
+            src_encs.expand(int(rows.count_nonzero()), -1, -1),
+            paths[rows, :tgt_len],
+            src_mask,
+            tgt_mask[:, :tgt_len, :tgt_len],
         )
-        logits = model.out_embed(tgt_encs[:, -1], inverse=True)
-        scores = probs[active].unsqueeze(1) + logits.log_softmax(dim=-1)
-        if i == 1:
-            scores = scores[0]
-
-        topv, topi = torch.topk(scores.flatten(), beam_size)
-        if beam_size < init_size:
-            active[~active] |= probs[~active] < topv.max() / i
-            active_count = int(active.count_nonzero())
-            if active_count > beam_size:
-                beam_size = active_count
-                topv, topi = torch.topk(scores.flatten(), beam_size)
-
-        reorder = topi // vocab.size()
-        paths[active] = paths[active][reorder]
-        paths[active, i] = topi % vocab.size()
-        probs[active] = topv
-
-        terminated = paths[:, i] == vocab.EOS
-        probs[terminated] /= i
-        active &= ~terminated
-        beam_size = int(active.count_nonzero())
+        logits = model.out_embed(tgt_encs[active[rows], i - 1], inverse=True)
+        with timed('beam_search'):
+            scores = probs[active].unsqueeze(1) + logits.float().log_softmax(dim=-1)
+            if i == 1:
+                scores = scores[0]
+
+            topv, topi = torch.topk(scores.flatten(), beam_size)
+            if beam_size < init_size:
+                active[~active] |= probs[~active] < topv.max() / i
+                active_count = int(active.count_nonzero())
+                if active_count > beam_size:
+                    beam_size = active_count
+                    topv, topi = torch.topk(scores.flatten(), beam_size)
+
+            reorder = topi // vocab.size()
+            paths[active] = paths[active][reorder]
+            paths[active, i] = topi % vocab.size()
+            probs[active] = topv
+
+            terminated = paths[:, i] == vocab.EOS
+            probs[terminated] /= i
+            active &= ~terminated
+            beam_size = int(active.count_nonzero())
 
     return paths[probs.argmax()]
+
+
+def batch_beam_search(
+    manager: 'Manager',
+    src_encs: Tensor,
+    src_mask: Tensor,
+    beam_size: int = 4,
+    max_length: int = 512,
+) -> Tensor:
+    model, vocab, device = manager.model, manager.vocab, manager.device
+    batch_size, vocab_size = src_encs.size(0), vocab.size()
+    src_encs = src_encs.repeat_interleave(beam_size, dim=0)
+    src_mask = src_mask.repeat_interleave(beam_size, dim=0)
+    tgt_mask = triu_mask(max_length, device=device)
+    active = torch.ones((batch_size, beam_size), dtype=torch.bool, device=device)
+    paths = torch.full((batch_size, beam_size, max_length), vocab.BOS, device=device)
+    probs = torch.zeros((batch_size, beam_size), device=device)
+    slots = torch.arange(beam_size, device=device).expand(batch_size, -1)
+    batches = torch.arange(batch_size, device=device).unsqueeze(1)
+
+    i = 0
+    while (i := i + 1) < max_length and active.any():
+        tgt_len = min(manager.bucket(i), max_length)
+        rows = torch.ones_like(active) if manager.compile else active
+        tgt_encs = manager.decode(
+            src_encs[rows.flatten()],
+            paths.flatten(0, 1)[rows.flatten(), :tgt_len],
+            src_mask[rows.flatten()],
+            tgt_mask[:, :tgt_len, :tgt_len],
+        )
+        logits = model.out_embed(tgt_encs[:, i - 1], inverse=True)
+        with timed('beam_search'):
+            scores = torch.full((batch_size, beam_size, vocab_size), -torch.inf, device=device)
+            scores[rows] = logits.float().log_softmax(dim=-1)
+            scores = (probs.unsqueeze(-1) + scores).masked_fill(~active.unsqueeze(-1), -torch.inf)
+            if i == 1:
+                scores[:, 1:] = -torch.inf
+
+            running = active.any(dim=1, keepdim=True)
+            topv, topi = torch.topk(scores.flatten(1), beam_size)
+            ranks = (active.cumsum(dim=1) - 1).clamp(min=0)
+            threshold = topv[:, :1] / i
+            active |= running & ~active & (probs < threshold)
+
+            order = torch.where(active, slots, slots + beam_size).argsort(dim=1)
+            count = active.sum(dim=1, keepdim=True)
+            valid = running & (slots < count)
+            sources = order.gather(1, ranks.gather(1, topi // vocab_size))
+            targets = torch.where(valid, order, slots)
+
+            b, t = batches.expand_as(targets)[valid], targets[valid]
+            paths[b, t] = paths[batches.expand_as(sources)[valid], sources[valid]]
+            paths[b, t, i] = (topi % vocab_size)[valid]
+            probs[b, t] = topv[valid]
+
+            terminated = torch.zeros_like(active)
+            terminated[b, t] = paths[b, t, i] == vocab.EOS
+            probs[terminated] /= i
+            active &= ~terminated
+
+    return paths[torch.arange(batch_size, device=device), probs.argmax(dim=1)]
@@ -3,6 +3,9 @@ import math
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+from profiler import timed
 
 Tensor = torch.Tensor
 Module = nn.Module
@@ -22,8 +25,36 @@ class Embedding(nn.Module):
 
     def forward(self, x: Tensor, inverse: bool = False) -> Tensor:
         if inverse:
-            return x @ nn.functional.normalize(self.weight, dim=-1).transpose(0, 1)
-        return self.scale * nn.functional.normalize(self.weight[x], dim=-1)
+            with timed('out_embed'):
+                weight = nn.functional.normalize(self.weight.float(), dim=-1)
+                return x @ weight.transpose(0, 1).to(x.dtype)
+        return self.scale * nn.functional.normalize(self.weight[x].float(), dim=-1)
+
+
+def chunked_cross_entropy(
+    embed: Embedding,
+    x: Tensor,
+    target: Tensor,
+    ignore_index: int = -100,
+    label_smoothing: float = 0.0,
+    chunk_size: int = 1024,
+) -> Tensor:
+    def chunk_loss(x: Tensor, target: Tensor, weight: Tensor) -> Tensor:
+        return nn.functional.cross_entropy(
+            x @ weight,
+            target,
+            ignore_index=ignore_index,
+            label_smoothing=label_smoothing,
+            reduction='sum',
+        )
+
+    x, target = torch.flatten(x, 0, 1), torch.flatten(target)
+    weight = nn.functional.normalize(embed.weight.float(), dim=-1).transpose(0, 1).to(x.dtype)
+    loss = x.new_zeros((), dtype=torch.float32)
+    for i in range(0, x.size(0), chunk_size):
+        chunk = slice(i, i + chunk_size)
+        loss = loss + checkpoint(chunk_loss, x[chunk], target[chunk], weight, use_reentrant=False)
+    return loss / (target != ignore_index).sum()
 
 
 class PositionalEncoding(nn.Module):
@@ -61,7 +92,7 @@ class ScaleNorm(nn.Module):
         self.scale = nn.Parameter(torch.tensor(scale))
 
     def forward(self, x: Tensor, eps: float = 1e-5) -> Tensor:
-        return self.scale * nn.functional.normalize(x, dim=-1, eps=eps)
+        return (self.scale * nn.functional.normalize(x.float(), dim=-1, eps=eps)).type_as(x)
 
 
 class MultiHeadAttention(nn.Module):
@@ -79,7 +110,7 @@ class MultiHeadAttention(nn.Module):
         scores = query @ key.transpose(-2, -1) / math.sqrt(self.head_dim)
         if mask is not None:
             scores.masked_fill_(mask.unsqueeze(1) == 0, -torch.inf)
-        return self.dropout(scores.softmax(dim=-1)) @ value
+        return self.dropout(scores.float().softmax(dim=-1).type_as(value)) @ value
 
     def _reshape_from(self, x: Tensor) -> Tensor:
         return x.reshape(*x.size()[:2], self.num_heads, self.head_dim)
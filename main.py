@@ -1,6 +1,7 @@
 import logging
 import math
 import random
+import sys
 import time
 from datetime import timedelta
 
@@ -8,12 +9,15 @@ import toml
 import torch
 from tqdm import tqdm
 
-from manager import Manager, Tokenizer
+import profiler
+from layers import chunked_cross_entropy
+from manager import Manager, Tokenizer, parse_value
 from score import score_model
+from telemetry import Telemetry
 
 Criterion = torch.nn.CrossEntropyLoss
 Optimizer = torch.optim.Optimizer
-Scaler = torch.cuda.amp.GradScaler
+Scaler = torch.amp.GradScaler
 Logger = logging.Logger
 
 
@@ -23,24 +27,42 @@ def train_epoch(
     optimizer: Optimizer | None = None,
     scaler: Scaler | None = None,
     use_tqdm: bool = False,
+    telemetry: Telemetry | None = None,
 ) -> float:
     data = manager.data if optimizer else manager.test
 
     total_loss, num_tokens = 0.0, 0
+    if telemetry is not None:
+        telemetry.start_epoch()
+    grad_norm, start = torch.zeros(()), time.perf_counter()
     for batch in tqdm(data, disable=(not use_tqdm)):
         src_nums, src_mask = batch.src_nums, batch.src_mask
         tgt_nums, tgt_mask = batch.tgt_nums, batch.tgt_mask
         batch_length = batch.length()
-
-        with torch.cuda.amp.autocast():
-            logits = manager.model(src_nums, tgt_nums[:, :-1], src_mask, tgt_mask)
-            loss = criterion(torch.flatten(logits, 0, 1), torch.flatten(tgt_nums[:, 1:]))
+        data_time = time.perf_counter() - start
+
+        with manager.autocast():
+            if manager.loss_chunk_size:
+                outputs = manager.forward(
+                    src_nums, tgt_nums[:, :-1], src_mask, tgt_mask, project=False
+                )
+                loss = chunked_cross_entropy(
+                    manager.model.out_embed,
+                    outputs,
+                    tgt_nums[:, 1:],
+                    criterion.ignore_index,
+                    criterion.label_smoothing,
+                    manager.loss_chunk_size,
+                )
+            else:
+                outputs = manager.forward(src_nums, tgt_nums[:, :-1], src_mask, tgt_mask)
+                loss = criterion(torch.flatten(outputs, 0, 1), torch.flatten(tgt_nums[:, 1:]))
 
         if optimizer and scaler:
             optimizer.zero_grad()
             scaler.scale(loss).backward()
             scaler.unscale_(optimizer)
-            torch.nn.utils.clip_grad_norm_(
+            grad_norm = torch.nn.utils.clip_grad_norm_(
                 manager.model.parameters(),
                 manager.clip_grad,
             )
@@ -49,13 +71,24 @@ def train_epoch(
 
         total_loss += batch_length * loss.item()
         num_tokens += batch_length
-        del logits, loss
+        del outputs, loss
+
+        if optimizer:
+            profiler.step()
+        if telemetry is not None and optimizer and scaler:
+            compute_time = time.perf_counter() - start - data_time
+            telemetry.update(batch, data_time, compute_time, float(grad_norm), scaler.get_scale())
+        start = time.perf_counter()
 
     return total_loss / num_tokens
 
 
 def train_model(
-    manager: Manager, tokenizer: Tokenizer, logger: Logger, use_tqdm: bool = False
+    manager: Manager,
+    tokenizer: Tokenizer,
+    logger: Logger,
+    use_tqdm: bool = False,
+    telemetry: Telemetry | None = None,
 ) -> tuple[tuple, list[str]]:
     model, vocab = manager.model, manager.vocab
     assert manager.data and len(manager.data) > 0
@@ -66,7 +99,7 @@ def train_model(
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
         optimizer, factor=manager.decay_factor, patience=manager.patience
     )
-    scaler = torch.cuda.amp.GradScaler()
+    scaler = torch.amp.GradScaler(manager.device, enabled=manager.use_scaler())
 
     best_loss = torch.inf
     for epoch in range(manager.max_epochs):
@@ -74,8 +107,10 @@ def train_model(
 
         model.train()
         start = time.perf_counter()
-        train_loss = train_epoch(manager, criterion, optimizer, scaler, use_tqdm)
+        train_loss = train_epoch(manager, criterion, optimizer, scaler, use_tqdm, telemetry)
         elapsed = timedelta(seconds=(time.perf_counter() - start))
+        if telemetry is not None:
+            telemetry.end_epoch(train_loss=train_loss, lr=optimizer.param_groups[0]['lr'])
 
         model.eval()
         with torch.no_grad():
@@ -87,6 +122,8 @@ def train_model(
         checkpoint += f' | Validation PPL = {math.exp(val_loss):.16f}'
         checkpoint += f' | Learning Rate = {optimizer.param_groups[0]["lr"]:.16f}'
         checkpoint += f' | Elapsed Time = {elapsed}'
+        if manager.compile:
+            checkpoint += f' | {manager.compile_stats()}'
         logger.info(checkpoint)
         print()
 
@@ -111,6 +148,10 @@ def main():
     parser.add_argument('--log', metavar='FILE', required=True, help='log file (.log)')
     parser.add_argument('--seed', type=int, help='random seed')
     parser.add_argument('--tqdm', action='store_true', help='import tqdm')
+    parser.add_argument('--profile', metavar='FILE', help='profiler trace (.json)')
+    parser.add_argument('--timing', action='store_true', help='time model components')
+    parser.add_argument('--metrics', metavar='FILE', help='metrics file (.jsonl)')
+    parser.add_argument('--prometheus', metavar='FILE', help='metrics file (.prom)')
     args, unknown = parser.parse_known_args()
 
     if args.seed:
@@ -125,7 +166,9 @@ def main():
     for i, arg in enumerate(unknown):
         if arg[:2] == '--' and len(unknown) > i:
             option, value = arg[2:].replace('-', '_'), unknown[i + 1]
-            config[option] = (int if value.isdigit() else float)(value)
+            config[option] = parse_value(value)
+    if args.timing and config.get('compile'):
+        parser.error('--timing cannot be combined with compile')
 
     manager = Manager(
         src_lang, tgt_lang, config, device, args.model, args.vocab, args.codes, args.data, args.test
@@ -138,7 +181,28 @@ def main():
     logger = logging.getLogger('torch.logger')
     logger.addHandler(logging.FileHandler(args.log))
 
-    train_model(manager, tokenizer, logger, args.tqdm)
+    if args.timing:
+        profiler.enable_timing(manager.model, device)
+    if args.profile:
+        profiler.start_profiler(
+            args.profile,
+            manager.profile_wait,
+            manager.profile_warmup,
+            manager.profile_steps,
+            device,
+        )
+
+    telemetry = None
+    if args.metrics or args.prometheus:
+        telemetry = Telemetry(device, manager.metrics_interval, args.metrics, args.prometheus)
+
+    train_model(manager, tokenizer, logger, args.tqdm, telemetry)
+
+    profiler.stop_profiler()
+    if telemetry is not None:
+        telemetry.close()
+    if args.timing:
+        print(profiler.timing_stats(), file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,12 @@
+import json
 import math
+import os
 import re
+import sys
+import time
+from datetime import timedelta
 from io import StringIO
+from typing import Callable
 
 import torch
 import torch.nn as nn
@@ -10,6 +16,72 @@ from torch import Tensor
 
 from decoder import triu_mask
 from model import Model
+from profiler import timed
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+TIED_WEIGHTS = ('src_embed.0.weight', 'tgt_embed.0.weight')
+
+
+def parse_value(value: str) -> bool | int | float | str:
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    if value.isdigit():
+        return int(value)
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def resolve_precision(precision: str, device: str, training: bool = False) -> str:
+    if precision != 'auto' and precision not in PRECISIONS:
+        raise ValueError(f'unknown precision {precision!r} (auto, fp32, bf16, fp16)')
+    if precision == 'auto':
+        return 'fp16' if training and device == 'cuda' else 'fp32'
+    if precision == 'fp16' and device == 'cpu':
+        if training:
+            raise ValueError('fp16 is not supported on cpu (use bf16 or fp32)')
+        return 'fp32'
+    return precision
+
+
+def shape_of(value):
+    return tuple(value.shape) if isinstance(value, Tensor) else value
+
+
+def sidecar_file(model_file: str) -> str:
+    return os.path.splitext(model_file)[0] + '.json'
+
+
+def load_checkpoint(model_file: str, device: str) -> dict:
+    if not model_file.endswith('.safetensors'):
+        return torch.load(model_file, map_location=device)
+
+    from safetensors.torch import load_file
+
+    with open(sidecar_file(model_file)) as file:
+        model_dict = json.load(file)
+    state_dict = load_file(model_file, device=device)
+    for name in TIED_WEIGHTS:
+        state_dict[name] = state_dict['out_embed.weight']
+    model_dict['state_dict'] = state_dict
+    return model_dict
+
+
+def save_checkpoint(model_file: str, model_dict: dict):
+    if not model_file.endswith('.safetensors'):
+        torch.save(model_dict, model_file)
+        return
+
+    from safetensors.torch import save_file
+
+    model_dict = dict(model_dict)
+    state_dict = dict(model_dict.pop('state_dict'))
+    for name in TIED_WEIGHTS:
+        del state_dict[name]
+    save_file(state_dict, model_file)
+    with open(sidecar_file(model_file), 'w') as file:
+        json.dump(model_dict, file)
 
 
 class Vocab:
@@ -75,6 +147,17 @@ class Batch:
     def length(self) -> int:
         return int((self.tgt_nums[:, 1:] != self.ignore_index).sum())
 
+    def src_length(self) -> int:
+        return int((self._src_nums[:, 1:] != self.ignore_index).sum())
+
+    def num_pads(self) -> int:
+        src_pads = (self._src_nums == self.ignore_index).sum()
+        tgt_pads = (self._tgt_nums == self.ignore_index).sum()
+        return int(src_pads + tgt_pads)
+
+    def numel(self) -> int:
+        return self._src_nums.numel() + self._tgt_nums.numel()
+
     def size(self) -> int:
         return self._src_nums.size(0)
 
@@ -87,14 +170,58 @@ class Tokenizer:
         self.tokenizer = MosesTokenizer(src_lang)
         lang = tgt_lang if tgt_lang else src_lang
         self.detokenizer = MosesDetokenizer(lang)
+        self.nonbreaking_prefixes = set(self.tokenizer.NONBREAKING_PREFIXES)
+        self.numeric_only_prefixes = set(self.tokenizer.NUMERIC_ONLY_PREFIXES)
 
     def tokenize(self, text: str) -> str:
-        tokens = self.tokenizer.tokenize(text)
-        return self.bpe.process_line(' '.join(tokens))
+        with timed('tokenize'):
+            tokens = self.tokenizer.tokenize(text)
+            return self.bpe.process_line(' '.join(tokens))
+
+    def _is_boundary(self, prev_word: str, next_word: str) -> bool:
+        word = prev_word.rstrip('\'")]»’”')
+        if not word or word[-1] not in '.?!':
+            return False
+        if not re.match(r'[\'"(\[«‘“¿¡]*[^\W_]', next_word):
+            return False
+        start = next_word.lstrip('\'"([«‘“¿¡')[0]
+        if not (start.isupper() or start.isdigit()):
+            return False
+        if word[-1] == '.' and word == prev_word:
+            if word.endswith('..'):
+                return start.isupper()
+            match = re.search(r'[\w.\-]*$', word[:-1])
+            prefix = match.group() if match else ''
+            if '.' in prefix and any(c.isalpha() for c in prefix):
+                return False
+            if prefix in self.nonbreaking_prefixes:
+                return False
+            if prefix in self.numeric_only_prefixes and start.isdigit():
+                return False
+        return True
+
+    def split_sentences(self, text: str) -> tuple[list[str], list[str]]:
+        body = text.strip()
+        if not body:
+            return [], [text]
+        lead = text[: len(text) - len(text.lstrip())]
+        trail = text[len(lead) + len(body) :]
+
+        tokens = re.split(r'(\s+)', body)
+        sentences, spaces, start = [], [lead], 0
+        for k in range(1, len(tokens), 2):
+            if re.search(r'\n\s*\n', tokens[k]) or self._is_boundary(tokens[k - 1], tokens[k + 1]):
+                sentences.append(''.join(tokens[start:k]))
+                spaces.append(tokens[k])
+                start = k + 1
+        sentences.append(''.join(tokens[start:]))
+        spaces.append(trail)
+        return sentences, spaces
 
     def detokenize(self, tokens: list[str]) -> str:
-        text = self.detokenizer.detokenize(tokens)
-        return re.sub('(@@ )|(@@ ?$)', '', text)
+        with timed('detokenize'):
+            text = self.detokenizer.detokenize(tokens)
+            return re.sub('(@@ )|(@@ ?$)', '', text)
 
 
 class Manager:
@@ -113,6 +240,15 @@ class Manager:
     batch_size: int
     max_length: int
     beam_size: int
+    precision: str = 'auto'
+    compile: bool = False
+    compile_cache: str = ''
+    profile_wait: int = 5
+    profile_warmup: int = 5
+    profile_steps: int = 10
+    metrics_interval: int = 100
+    checkpoint_layers: int = 0
+    loss_chunk_size: int = 0
 
     def __init__(
         self,
@@ -125,6 +261,7 @@ class Manager:
         codes_file: str | list[str],
         data_file: str | None = None,
         test_file: str | None = None,
+        state_dict: dict | None = None,
     ):
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
@@ -136,25 +273,40 @@ class Manager:
 
         for option, value in config.items():
             self.__setattr__(option, value)
+        self.precision = resolve_precision(self.precision, device, training=data_file is not None)
+        self.dtype = PRECISIONS[self.precision]
 
         if isinstance(self._vocab_list, str):
             with open(self._vocab_list) as file:
                 self._vocab_list = list(file.readlines())
-        self.vocab = Vocab(self._vocab_list)
-
         if isinstance(self._codes_list, str):
             with open(self._codes_list) as file:
                 self._codes_list = list(file.readlines())
+
+        self.vocab = Vocab(self._vocab_list)
         self.bpe = BPE(StringIO(''.join(self._codes_list)))
 
-        self.model = Model(
-            self.vocab.size(),
-            self.embed_dim,
-            self.ff_dim,
-            self.num_heads,
-            self.dropout,
-            self.num_layers,
-        ).to(device)
+        with torch.device('meta' if state_dict is not None else 'cpu'):
+            self.model = Model(
+                self.vocab.size(),
+                self.embed_dim,
+                self.ff_dim,
+                self.num_heads,
+                self.dropout,
+                self.num_layers,
+                self.checkpoint_layers,
+            )
+        if state_dict is not None:
+            self.model.load_state_dict(state_dict, assign=True)
+        self.model = self.model.to(device)
+
+        self.compile_time = 0.0
+        self._compiled: list[set[tuple]] = []
+        self._forward: Callable[..., Tensor] = self.model
+        self._encode: Callable[..., Tensor] = self.model.encode
+        self._decode: Callable[..., Tensor] = self.model.decode
+        if self.compile:
+            self.compile_model(training=data_file is not None)
 
         self.data = None
         if data_file is not None:
@@ -164,8 +316,83 @@ class Manager:
         if test_file is not None:
             self.test = self.batch_data(test_file)
 
+    def autocast(self) -> torch.autocast:
+        return torch.autocast(self.device, dtype=self.dtype, enabled=self.dtype != torch.float32)
+
+    def use_scaler(self) -> bool:
+        return self.dtype == torch.float16 and self.device == 'cuda'
+
+    def bucket(self, length: int) -> int:
+        if not self.compile:
+            return length
+        return max(16, 2 ** math.ceil(math.log2(length)))
+
+    def compile_model(self, training: bool = False):
+        import torch._dynamo
+        import torch._inductor.config
+
+        if self.compile_cache:
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = self.compile_cache
+        torch._inductor.config.fx_graph_cache = True
+        torch._dynamo.config.cache_size_limit = 64
+
+        if training:
+            self._forward = self._compile(self.model)
+        else:
+            self._encode = self._compile(self.model.encode)
+            self._decode = self._compile(self.model.decode)
+
+    def forward(self, *args, **kwargs) -> Tensor:
+        return self._forward(*args, **kwargs)
+
+    def encode(self, src_nums: Tensor, src_mask: Tensor | None = None) -> Tensor:
+        batch_size = src_nums.size(0)
+        padding = 2 ** math.ceil(math.log2(batch_size)) - batch_size if self.compile else 0
+        if padding > 0:
+            src_nums = torch.cat([src_nums, src_nums[:1].expand(padding, -1)])
+            if src_mask is not None:
+                src_mask = torch.cat([src_mask, src_mask[:1].expand(padding, -1, -1)])
+        return self._encode(src_nums, src_mask)[:batch_size]
+
+    def decode(self, *args, **kwargs) -> Tensor:
+        return self._decode(*args, **kwargs)
+
+    def _compile(self, function: Callable) -> Callable:
+        compiled = torch.compile(function, dynamic=False)
+        signatures: set[tuple] = set()
+        self._compiled.append(signatures)
+
+        def wrapper(*args, **kwargs):
+            signature = (self.model.training, torch.is_grad_enabled())
+            signature += tuple(map(shape_of, args)) + tuple(
+                (name, shape_of(value)) for name, value in sorted(kwargs.items())
+            )
+            if signature in signatures:
+                return compiled(*args, **kwargs)
+            signatures.add(signature)
+            if len(signatures) == torch._dynamo.config.cache_size_limit + 1:
+                print(
+                    f'Compile: cache size limit ({len(signatures) - 1}) reached, '
+                    'new shapes fall back to eager mode',
+                    file=sys.stderr,
+                )
+            start = time.perf_counter()
+            outputs = compiled(*args, **kwargs)
+            self.compile_time += time.perf_counter() - start
+            return outputs
+
+        return wrapper
+
+    def compile_stats(self) -> str:
+        num_shapes = sum(len(signatures) for signatures in self._compiled)
+        checkpoint = f'Compiled Shapes = {num_shapes}'
+        checkpoint += f' | Recompiles = {num_shapes - sum(map(bool, self._compiled))}'
+        checkpoint += f' | Compile Time = {timedelta(seconds=self.compile_time)}'
+        return checkpoint
+
     def save_model(self):
-        torch.save(
+        save_checkpoint(
+            self._model_name,
             {
                 'state_dict': self.model.state_dict(),
                 'src_lang': self.src_lang,
@@ -174,7 +401,6 @@ class Manager:
                 'codes_list': self._codes_list,
                 'model_config': self.config,
             },
-            self._model_name,
         )
 
     def batch_data(self, data_file: str) -> list[Batch]:
@@ -216,8 +442,8 @@ class Manager:
                     break
                 src_len, tgt_len = max_src_len, max_tgt_len
 
-            max_src_len = math.ceil(max_src_len / 8) * 8
-            max_tgt_len = math.ceil(max_tgt_len / 8) * 8
+            max_src_len = self.bucket(math.ceil(max_src_len / 8) * 8)
+            max_tgt_len = self.bucket(math.ceil(max_tgt_len / 8) * 8)
 
             src_nums = torch.stack(
                 [
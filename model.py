@@ -1,7 +1,9 @@
 from typing import Callable
 
+import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 
 from layers import (
     Embedding,
@@ -11,6 +13,7 @@ from layers import (
     ScaleNorm,
     clone,
 )
+from profiler import checkpoint_contexts
 
 Sublayer = Callable[[Tensor], Tensor]
 
@@ -39,9 +42,16 @@ class EncoderLayer(nn.Module):
 
 class Encoder(nn.Module):
     def __init__(
-        self, embed_dim: int, ff_dim: int, num_heads: int, dropout: float, num_layers: int
+        self,
+        embed_dim: int,
+        ff_dim: int,
+        num_heads: int,
+        dropout: float,
+        num_layers: int,
+        checkpoint_layers: int = 0,
     ):
         super(Encoder, self).__init__()
+        self.checkpoint_layers = checkpoint_layers
         self.layers = clone(EncoderLayer(embed_dim, ff_dim, num_heads, dropout), num_layers)
         for p in self.parameters():
             if p.dim() > 1:
@@ -50,8 +60,13 @@ class Encoder(nn.Module):
 
     def forward(self, src_embs: Tensor, src_mask: Tensor | None = None) -> Tensor:
         src_encs = src_embs
-        for layer in self.layers:
-            src_encs = layer(src_encs, src_mask)
+        for i, layer in enumerate(self.layers):
+            if i < self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                src_encs = checkpoint(
+                    layer, src_encs, src_mask, use_reentrant=False, context_fn=checkpoint_contexts
+                )
+            else:
+                src_encs = layer(src_encs, src_mask)
         return self.norm(src_encs)
 
 
@@ -78,9 +93,16 @@ class DecoderLayer(nn.Module):
 
 class Decoder(nn.Module):
     def __init__(
-        self, embed_dim: int, ff_dim: int, num_heads: int, dropout: float, num_layers: int
+        self,
+        embed_dim: int,
+        ff_dim: int,
+        num_heads: int,
+        dropout: float,
+        num_layers: int,
+        checkpoint_layers: int = 0,
     ):
         super(Decoder, self).__init__()
+        self.checkpoint_layers = checkpoint_layers
         self.layers = clone(DecoderLayer(embed_dim, ff_dim, num_heads, dropout), num_layers)
         for p in self.parameters():
             if p.dim() > 1:
@@ -95,8 +117,19 @@ class Decoder(nn.Module):
         tgt_mask: Tensor | None = None,
     ) -> Tensor:
         tgt_encs = tgt_embs
-        for layer in self.layers:
-            tgt_encs = layer(src_encs, tgt_encs, src_mask, tgt_mask)
+        for i, layer in enumerate(self.layers):
+            if i < self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                tgt_encs = checkpoint(
+                    layer,
+                    src_encs,
+                    tgt_encs,
+                    src_mask,
+                    tgt_mask,
+                    use_reentrant=False,
+                    context_fn=checkpoint_contexts,
+                )
+            else:
+                tgt_encs = layer(src_encs, tgt_encs, src_mask, tgt_mask)
         return self.norm(tgt_encs)
 
 
@@ -109,10 +142,11 @@ class Model(nn.Module):
         num_heads: int,
         dropout: float,
         num_layers: int,
+        checkpoint_layers: int = 0,
     ):
         super(Model, self).__init__()
-        self.encoder = Encoder(embed_dim, ff_dim, num_heads, dropout, num_layers)
-        self.decoder = Decoder(embed_dim, ff_dim, num_heads, dropout, num_layers)
+        self.encoder = Encoder(embed_dim, ff_dim, num_heads, dropout, num_layers, checkpoint_layers)
+        self.decoder = Decoder(embed_dim, ff_dim, num_heads, dropout, num_layers, checkpoint_layers)
         self.out_embed = Embedding(embed_dim, vocab_dim)
         self.src_embed = nn.Sequential(self.out_embed, PositionalEncoding(embed_dim, dropout))
         self.tgt_embed = nn.Sequential(self.out_embed, PositionalEncoding(embed_dim, dropout))
@@ -137,7 +171,10 @@ class Model(nn.Module):
         tgt_nums: Tensor,
         src_mask: Tensor | None = None,
         tgt_mask: Tensor | None = None,
+        project: bool = True,
     ) -> Tensor:
         src_encs = self.encode(src_nums, src_mask)
         tgt_encs = self.decode(src_encs, tgt_nums, src_mask, tgt_mask)
+        if not project:
+            return tgt_encs
         return self.out_embed(tgt_encs, inverse=True)
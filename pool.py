@@ -0,0 +1,47 @@
+import os
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Iterable
+
+import torch
+import torch.multiprocessing as mp
+
+if TYPE_CHECKING:
+    from manager import Manager, Tokenizer
+
+_state: dict[str, Any] = {}
+
+
+def _init_worker(num_threads: int):
+    torch.set_num_threads(num_threads)
+
+
+def _apply(function: Callable, item: Any) -> Any:
+    return function(item, _state['manager'], _state['tokenizer'])
+
+
+class InferencePool:
+    def __init__(
+        self,
+        manager: 'Manager',
+        tokenizer: 'Tokenizer',
+        num_workers: int,
+        chunk_size: int = 8,
+    ):
+        if manager.device != 'cpu':
+            raise ValueError(f'inference pool requires the cpu device (got {manager.device})')
+        manager.model.eval()
+        manager.model.share_memory()
+        _state.update(manager=manager, tokenizer=tokenizer)
+
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        self.pool = mp.get_context('fork').Pool(num_workers, _init_worker, (num_threads,))
+
+    def map(self, function: Callable, items: Iterable, chunk_size: int | None = None) -> list:
+        chunk_size = chunk_size or self.chunk_size
+        return list(self.pool.imap(partial(_apply, function), items, chunk_size))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
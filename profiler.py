@@ -0,0 +1,123 @@
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
+from typing import TYPE_CHECKING, ContextManager, Iterator, cast
+
+import torch
+import torch.nn as nn
+
+if TYPE_CHECKING:
+    from model import DecoderLayer, Model
+
+_enabled = False
+_synchronize = False
+_totals: dict[str, float] = defaultdict(float)
+_counts: dict[str, int] = defaultdict(int)
+_profiler: torch.profiler.profile | None = None
+_exported = False
+_steps = _window = 0
+
+
+class Timed:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        if _enabled:
+            if _synchronize:
+                torch.cuda.synchronize()
+            self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        if _enabled:
+            if _synchronize:
+                torch.cuda.synchronize()
+            _totals[self.name] += time.perf_counter() - self.start
+            _counts[self.name] += 1
+
+
+def timed(name: str) -> Timed:
+    return Timed(name)
+
+
+@contextmanager
+def paused() -> Iterator[None]:
+    global _enabled
+    enabled, _enabled = _enabled, False
+    try:
+        yield
+    finally:
+        _enabled = enabled
+
+
+def checkpoint_contexts() -> tuple[ContextManager, ContextManager]:
+    return nullcontext(), paused()
+
+
+def _register(module: nn.Module, name: str):
+    timer = Timed(name)
+    module.register_forward_pre_hook(lambda *_: timer.__enter__())
+    module.register_forward_hook(lambda *_: timer.__exit__())
+
+
+def enable_timing(model: 'Model | None' = None, device: str = 'cpu'):
+    global _enabled, _synchronize
+    _enabled, _synchronize = True, device == 'cuda'
+    if model is None:
+        return
+    _register(model.encoder, 'Encoder')
+    for i, module in enumerate(model.decoder.layers):
+        layer = cast('DecoderLayer', module)
+        _register(layer, f'DecoderLayer[{i}]')
+        _register(layer.crss_attn, f'DecoderLayer[{i}].crss_attn')
+
+
+def timing_stats() -> str:
+    return ' | '.join(
+        f'{name} = {timedelta(seconds=total)} ({_counts[name]} calls)'
+        for name, total in sorted(_totals.items(), key=lambda x: x[1], reverse=True)
+    )
+
+
+def start_profiler(trace_file: str, wait: int, warmup: int, active: int, device: str = 'cpu'):
+    global _profiler, _exported, _steps, _window
+    _exported, _steps, _window = False, 0, wait + warmup
+
+    def export(prof: torch.profiler.profile):
+        global _exported
+        prof.export_chrome_trace(trace_file)
+        _exported = True
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    _profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=export,
+        record_shapes=True,
+        with_stack=True,
+    )
+    _profiler.start()
+
+
+def step():
+    global _steps
+    if _profiler is not None:
+        _profiler.step()
+        _steps += 1
+
+
+def stop_profiler():
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler = None
+        if not _exported:
+            print(
+                f'Profiler: no trace exported ({_steps} steps, {_window} needed before recording)',
+                file=sys.stderr,
+            )
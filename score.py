@@ -1,20 +1,33 @@
 import logging
+import sys
 import time
 from datetime import timedelta
 
-import comet
 import torch
-from sacrebleu.metrics import BLEU, CHRF
 from tqdm import tqdm
 
+import profiler
 from decoder import beam_search
-from manager import Manager, Tokenizer
+from manager import Manager, Tokenizer, load_checkpoint, parse_value
+from pool import InferencePool
 
 Logger = logging.Logger
 
 
+def search_nums(src_list: list[int], manager: Manager, tokenizer: Tokenizer) -> list[int]:
+    with torch.no_grad(), manager.autocast():
+        src_nums = torch.tensor(src_list, device=manager.device).unsqueeze(0)
+        src_mask = (src_nums != manager.vocab.PAD).unsqueeze(-2)
+        src_encs = manager.encode(src_nums, src_mask)
+        return beam_search(manager, src_encs, src_mask, manager.beam_size).tolist()
+
+
 def score_model(
-    manager: Manager, tokenizer: Tokenizer, logger: Logger, use_tqdm: bool = False
+    manager: Manager,
+    tokenizer: Tokenizer,
+    logger: Logger,
+    use_tqdm: bool = False,
+    pool: InferencePool | None = None,
 ) -> tuple[tuple, list[str]]:
     model, vocab = manager.model, manager.vocab
     assert manager.test and len(manager.test) > 0
@@ -22,16 +35,28 @@ def score_model(
 
     start = time.perf_counter()
     model.eval()
-    with torch.no_grad():
-        for batch in tqdm(manager.test, disable=(not use_tqdm)):
-            src_nums, src_mask = batch.src_nums, batch.src_mask
-            src_encs, tgt_nums = model.encode(src_nums, src_mask), batch.tgt_nums
-            for i in tqdm(range(src_encs.size(0)), leave=False, disable=(not use_tqdm)):
-                out_nums = beam_search(manager, src_encs[i], src_mask[i], manager.beam_size)
-                reference.append(tokenizer.detokenize(vocab.denumberize(tgt_nums[i].tolist())))
-                candidate.append(tokenizer.detokenize(vocab.denumberize(out_nums.tolist())))
+    if pool is not None:
+        src_lists = [nums.tolist() for batch in manager.test for nums in batch.src_nums]
+        tgt_lists = [nums.tolist() for batch in manager.test for nums in batch.tgt_nums]
+        for tgt_list, out_list in zip(tgt_lists, pool.map(search_nums, src_lists)):
+            reference.append(tokenizer.detokenize(vocab.denumberize(tgt_list)))
+            candidate.append(tokenizer.detokenize(vocab.denumberize(out_list)))
+    else:
+        with torch.no_grad(), manager.autocast():
+            for batch in tqdm(manager.test, disable=(not use_tqdm)):
+                src_nums, src_mask = batch.src_nums, batch.src_mask
+                src_encs, tgt_nums = manager.encode(src_nums, src_mask), batch.tgt_nums
+                for i in tqdm(range(src_encs.size(0)), leave=False, disable=(not use_tqdm)):
+                    out_nums = beam_search(manager, src_encs[i], src_mask[i], manager.beam_size)
+                    tgt_words = vocab.denumberize(tgt_nums[i].tolist())
+                    out_words = vocab.denumberize(out_nums.tolist())
+                    reference.append(tokenizer.detokenize(tgt_words))
+                    candidate.append(tokenizer.detokenize(out_words))
+                    profiler.step()
     elapsed = timedelta(seconds=(time.perf_counter() - start))
 
+    from sacrebleu.metrics import BLEU, CHRF
+
     bleu_score = BLEU().corpus_score(candidate, [reference])
     chrf_score = CHRF().corpus_score(candidate, [reference])
 
@@ -41,6 +66,8 @@ def score_model(
         for j, src_nums in enumerate(batch.src_nums):
             src_words = tokenizer.detokenize(vocab.denumberize(src_nums.tolist()))
             samples.append({'src': src_words, 'mt': candidate[i + j], 'ref': reference[i + j]})
+    import comet
+
     comet_model = comet.load_from_checkpoint(comet.download_model('Unbabel/wmt22-comet-da'))
     comet_score = comet_model.predict(samples)['system_score']
 
@@ -48,6 +75,8 @@ def score_model(
     checkpoint += f' | CHRF = {chrf_score.score:.16f}'
     checkpoint += f' | COMET = {comet_score:.16f}'
     checkpoint += f' | Elapsed Time = {elapsed}'
+    if manager.compile:
+        checkpoint += f' | {manager.compile_stats()}'
     logger.info(checkpoint)
 
     return (bleu_score, chrf_score, comet_score), candidate
@@ -58,18 +87,27 @@ def main():
     parser.add_argument('--data', metavar='FILE', required=True, help='testing data')
     parser.add_argument('--model', metavar='FILE', required=True, help='model file (.pt)')
     parser.add_argument('--tqdm', action='store_true', help='import tqdm')
+    parser.add_argument('--profile', metavar='FILE', help='profiler trace (.json)')
+    parser.add_argument('--timing', action='store_true', help='time model components')
+    parser.add_argument('--workers', type=int, default=0, help='inference workers (CPU)')
     args, unknown = parser.parse_known_args()
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model_dict = torch.load(args.model, map_location=device)
+    if args.workers and device != 'cpu':
+        parser.error('--workers is only supported on CPU-only hosts')
+    if args.workers and (args.profile or args.timing):
+        parser.error('--workers cannot be combined with --profile or --timing')
+    model_dict = load_checkpoint(args.model, device)
     src_lang, tgt_lang = model_dict['src_lang'], model_dict['tgt_lang']
     vocab_list, codes_list = model_dict['vocab_list'], model_dict['codes_list']
 
-    config = model_dict['model_config']
+    config = model_dict['model_config'] | {'precision': 'auto'}
     for i, arg in enumerate(unknown):
         if arg[:2] == '--' and len(unknown) > i:
             option, value = arg[2:].replace('-', '_'), unknown[i + 1]
-            config[option] = (int if value.isdigit() else float)(value)
+            config[option] = parse_value(value)
+    if args.timing and config.get('compile'):
+        parser.error('--timing cannot be combined with compile')
 
     manager = Manager(
         src_lang,
@@ -80,9 +118,9 @@ def main():
         vocab_list,
         codes_list,
         data_file=None,
-        test_file=args.test,
+        test_file=args.data,
+        state_dict=model_dict['state_dict'],
     )
-    manager.model.load_state_dict(model_dict['state_dict'])
     tokenizer = Tokenizer(manager.bpe, src_lang, tgt_lang)
 
     if device == 'cuda' and torch.cuda.get_device_capability()[0] >= 8:
@@ -90,7 +128,25 @@ def main():
 
     logger = logging.getLogger('torch.logger')
 
-    *_, candidate = score_model(manager, tokenizer, logger, args.tqdm)
+    if args.timing:
+        profiler.enable_timing(manager.model, device)
+    if args.profile:
+        profiler.start_profiler(
+            args.profile,
+            manager.profile_wait,
+            manager.profile_warmup,
+            manager.profile_steps,
+            device,
+        )
+
+    pool = InferencePool(manager, tokenizer, args.workers) if args.workers else None
+    *_, candidate = score_model(manager, tokenizer, logger, args.tqdm, pool)
+    if pool is not None:
+        pool.close()
+
+    profiler.stop_profiler()
+    if args.timing:
+        print(profiler.timing_stats(), file=sys.stderr)
     print('', *candidate, sep='\n')
 
 
@@ -0,0 +1,137 @@
+import json
+import math
+import os
+import resource
+import time
+from typing import TYPE_CHECKING
+
+import torch
+
+if TYPE_CHECKING:
+    from manager import Batch
+
+COUNTERS = (
+    'steps',
+    'sentences',
+    'src_tokens',
+    'tgt_tokens',
+    'pad_tokens',
+    'all_tokens',
+    'data_time',
+    'compute_time',
+    'grad_norm',
+    'grad_steps',
+)
+
+
+class Telemetry:
+    def __init__(
+        self,
+        device: str,
+        interval: int,
+        metrics_file: str | None = None,
+        prometheus_file: str | None = None,
+    ):
+        self.device = device
+        self.interval = interval
+        self.metrics_file = open(metrics_file, 'a') if metrics_file else None
+        self.prometheus_file = prometheus_file
+        self.epoch = self.step = 0
+        self.loss_scale = 1.0
+        self._records: dict[str, dict] = {}
+        self._window = self._reset()
+        self._totals = self._reset()
+
+    @staticmethod
+    def _reset() -> dict[str, float]:
+        counters = dict.fromkeys(COUNTERS, 0.0)
+        counters['start'] = time.perf_counter()
+        return counters
+
+    def update(
+        self,
+        batch: 'Batch',
+        data_time: float,
+        compute_time: float,
+        grad_norm: float,
+        loss_scale: float,
+    ):
+        num_pads = batch.num_pads()
+        for counters in (self._window, self._totals):
+            counters['steps'] += 1
+            counters['sentences'] += batch.size()
+            counters['src_tokens'] += batch.src_length()
+            counters['tgt_tokens'] += batch.length()
+            counters['pad_tokens'] += num_pads
+            counters['all_tokens'] += batch.numel()
+            counters['data_time'] += data_time
+            counters['compute_time'] += compute_time
+            if math.isfinite(grad_norm):
+                counters['grad_norm'] += grad_norm
+                counters['grad_steps'] += 1
+        self.loss_scale = loss_scale
+
+        self.step += 1
+        if self.interval and self.step % self.interval == 0:
+            self.emit('step', self._window)
+            self._window = self._reset()
+
+    def start_epoch(self):
+        self._window = self._reset()
+        self._totals = self._reset()
+
+    def end_epoch(self, **metrics: float):
+        self.epoch += 1
+        self.emit('epoch', self._totals, **metrics)
+        self._window = self._reset()
+        self._totals = self._reset()
+
+    def _memory(self) -> dict[str, float]:
+        memory = {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if self.device == 'cuda':
+            memory['peak_allocated_mb'] = torch.cuda.max_memory_allocated() / 2**20
+            memory['peak_reserved_mb'] = torch.cuda.max_memory_reserved() / 2**20
+        return memory
+
+    def emit(self, scope: str, counters: dict[str, float], **metrics: float):
+        elapsed = max(time.perf_counter() - counters['start'], 1e-9)
+        record = {
+            'scope': scope,
+            'epoch': self.epoch,
+            'step': self.step,
+            'src_tokens_per_sec': counters['src_tokens'] / elapsed,
+            'tgt_tokens_per_sec': counters['tgt_tokens'] / elapsed,
+            'sentences_per_sec': counters['sentences'] / elapsed,
+            'padding_ratio': counters['pad_tokens'] / max(counters['all_tokens'], 1),
+            'grad_norm': counters['grad_norm'] / max(counters['grad_steps'], 1),
+            'skipped_steps': counters['steps'] - counters['grad_steps'],
+            'loss_scale': self.loss_scale,
+            'data_time': counters['data_time'],
+            'compute_time': counters['compute_time'],
+            'elapsed_time': elapsed,
+        }
+        record |= self._memory() | metrics
+        for name, value in record.items():
+            if isinstance(value, float) and not math.isfinite(value):
+                record[name] = None
+
+        if self.metrics_file is not None:
+            self.metrics_file.write(json.dumps(record, allow_nan=False) + '\n')
+            self.metrics_file.flush()
+        if self.prometheus_file is not None:
+            self._records[scope] = record
+            self._export()
+
+    def _export(self):
+        lines = []
+        for scope, record in self._records.items():
+            for name, value in record.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'translation_{name}{{scope="{scope}"}} {value}')
+        with open(self.prometheus_file + '.tmp', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(self.prometheus_file + '.tmp', self.prometheus_file)
+
+    def close(self):
+        if self.metrics_file is not None:
+            self.metrics_file.close()
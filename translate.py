@@ -1,12 +1,74 @@
+import math
+import sys
+
 import torch
 
-from decoder import beam_search
-from manager import Manager, Tokenizer
+import profiler
+from decoder import batch_beam_search, beam_search
+from manager import Manager, Tokenizer, load_checkpoint, parse_value
+from pool import InferencePool
 
 
-def translate_file(data_file: str, manager: Manager, tokenizer: Tokenizer) -> list[str]:
+def translate_file(
+    data_file: str, manager: Manager, tokenizer: Tokenizer, pool: InferencePool | None = None
+) -> list[str]:
     with open(data_file) as file:
-        return [translate_string(line, manager, tokenizer) for line in file]
+        return (
+            pool.map(translate_string, file)
+            if pool
+            else [translate_string(line, manager, tokenizer) for line in file]
+        )
+
+
+def translate_document(
+    document: str, manager: Manager, tokenizer: Tokenizer, pool: InferencePool | None = None
+) -> str:
+    sentences, spaces = tokenizer.split_sentences(document)
+    if pool is not None:
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+        groups = [order[i :: pool.num_workers] for i in range(pool.num_workers)]
+        batches = [[sentences[k] for k in group] for group in groups]
+        translations = [''] * len(sentences)
+        for group, batch in zip(groups, pool.map(translate_batch, batches, chunk_size=1)):
+            for k, translation in zip(group, batch):
+                translations[k] = translation
+    else:
+        translations = translate_batch(sentences, manager, tokenizer)
+    return spaces[0] + ''.join(x + y for x, y in zip(translations, spaces[1:]))
+
+
+def translate_batch(strings: list[str], manager: Manager, tokenizer: Tokenizer) -> list[str]:
+    model, vocab, device = manager.model, manager.vocab, manager.device
+    src_lists = [
+        vocab.numberize(['<BOS>'] + tokenizer.tokenize(string).split() + ['<EOS>'])
+        for string in strings
+    ]
+    order = sorted(range(len(src_lists)), key=lambda i: len(src_lists[i]), reverse=True)
+    translations = [''] * len(strings)
+
+    model.eval()
+    with torch.no_grad(), manager.autocast():
+        i = batch_size = 0
+        while (i := i + batch_size) < len(order):
+            max_length = manager.bucket(len(src_lists[order[i]]))
+            capacity = max(1, manager.batch_size // (max_length * manager.beam_size))
+            batch_size = 2 ** int(math.log2(capacity))
+            batch = order[i : (i + batch_size)]
+            if manager.compile:
+                batch += batch[:1] * (2 ** math.ceil(math.log2(len(batch))) - len(batch))
+
+            src_nums = torch.tensor(
+                [src_lists[k] + [vocab.PAD] * (max_length - len(src_lists[k])) for k in batch],
+                device=device,
+            )
+            src_mask = (src_nums != vocab.PAD).unsqueeze(-2)
+            src_encs = manager.encode(src_nums, src_mask)
+            out_nums = batch_beam_search(manager, src_encs, src_mask, manager.beam_size)
+            for j, k in enumerate(batch):
+                translations[k] = tokenizer.detokenize(vocab.denumberize(out_nums[j].tolist()))
+            profiler.step()
+
+    return translations
 
 
 def translate_string(string: str, manager: Manager, tokenizer: Tokenizer) -> str:
@@ -14,11 +76,16 @@ def translate_string(string: str, manager: Manager, tokenizer: Tokenizer) -> str
     src_words = ['<BOS>'] + tokenizer.tokenize(string).split() + ['<EOS>']
 
     model.eval()
-    with torch.no_grad():
-        src_nums, src_mask = torch.tensor(vocab.numberize(src_words)), None
-        src_encs = model.encode(src_nums.unsqueeze(0).to(device), src_mask)
+    with torch.no_grad(), manager.autocast():
+        src_nums = torch.tensor(vocab.numberize(src_words))
+        src_nums = torch.nn.functional.pad(
+            src_nums, (0, manager.bucket(len(src_words)) - len(src_words)), value=vocab.PAD
+        ).unsqueeze(0)
+        src_mask = (src_nums != vocab.PAD).unsqueeze(-2).to(device) if manager.compile else None
+        src_encs = manager.encode(src_nums.to(device), src_mask)
         out_nums = beam_search(manager, src_encs, src_mask, manager.beam_size)
 
+    profiler.step()
     return tokenizer.detokenize(vocab.denumberize(out_nums.tolist()))
 
 
@@ -28,18 +95,30 @@ def main():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--string', metavar='STRING', help='input string')
     group.add_argument('--file', metavar='FILE', help='input file')
+    parser.add_argument('--profile', metavar='FILE', help='profiler trace (.json)')
+    parser.add_argument('--timing', action='store_true', help='time model components')
+    parser.add_argument('--workers', type=int, default=0, help='inference workers (CPU)')
+    parser.add_argument('--document', action='store_true', help='document mode (sentence split)')
     args, unknown = parser.parse_known_args()
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model_dict = torch.load(args.model, map_location=device)
+    if args.workers and device != 'cpu':
+        parser.error('--workers is only supported on CPU-only hosts')
+    if args.workers and (args.profile or args.timing):
+        parser.error('--workers cannot be combined with --profile or --timing')
+    if args.workers and not (args.file or args.document):
+        parser.error('--workers requires --file or --document')
+    model_dict = load_checkpoint(args.model, device)
     src_lang, tgt_lang = model_dict['src_lang'], model_dict['tgt_lang']
     vocab_list, codes_list = model_dict['vocab_list'], model_dict['codes_list']
 
-    config = model_dict['model_config']
+    config = model_dict['model_config'] | {'precision': 'auto'}
     for i, arg in enumerate(unknown):
         if arg[:2] == '--' and len(unknown) > i:
             option, value = arg[2:].replace('-', '_'), unknown[i + 1]
-            config[option] = (int if value.isdigit() else float)(value)
+            config[option] = parse_value(value)
+    if args.timing and config.get('compile'):
+        parser.error('--timing cannot be combined with compile')
 
     manager = Manager(
         src_lang,
@@ -51,20 +130,47 @@ def main():
         codes_list,
         data_file=None,
         test_file=None,
+        state_dict=model_dict['state_dict'],
     )
-    manager.model.load_state_dict(model_dict['state_dict'])
     tokenizer = Tokenizer(manager.bpe, src_lang, tgt_lang)
 
     if device == 'cuda' and torch.cuda.get_device_capability()[0] >= 8:
         torch.set_float32_matmul_precision('high')
 
-    if args.file:
-        data_file = open(args.file)
-        print(*translate_file(data_file, manager, tokenizer), sep='\n')
-        data_file.close()
+    if args.timing:
+        profiler.enable_timing(manager.model, device)
+    if args.profile:
+        profiler.start_profiler(
+            args.profile,
+            manager.profile_wait,
+            manager.profile_warmup,
+            manager.profile_steps,
+            device,
+        )
+
+    if args.document or args.file:
+        pool = InferencePool(manager, tokenizer, args.workers) if args.workers else None
+        if args.document:
+            if args.file:
+                with open(args.file) as file:
+                    document = file.read()
+            else:
+                document = args.string
+            translation = translate_document(document, manager, tokenizer, pool)
+            print(translation, end='' if args.file else '\n')
+        else:
+            print(*translate_file(args.file, manager, tokenizer, pool), sep='\n')
+        if pool is not None:
+            pool.close()
     elif args.string:
         print(translate_string(args.string, manager, tokenizer))
 
+    profiler.stop_profiler()
+    if args.timing:
+        print(profiler.timing_stats(), file=sys.stderr)
+    if manager.compile:
+        print(manager.compile_stats(), file=sys.stderr)
+
 
 if __name__ == '__main__':
     import argparse